@@ -1,9 +1,13 @@
 import asyncio
+import hashlib
+import io
+import json
 import logging
 import os
+import random
 import sqlite3
+import threading
 import time
-from contextlib import closing
 from typing import List, Tuple
 
 from aiogram import Bot, Dispatcher, F
@@ -11,11 +15,17 @@ from aiogram.filters import CommandStart, Command
 from aiogram.types import Message
 from aiogram.enums import ChatAction
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from dotenv import load_dotenv
-import ffmpeg
 
 import httpx
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
 import openai as openai_pkg  # только чтобы залогировать версию SDK
 
 load_dotenv()
@@ -28,6 +38,9 @@ SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "Ты — помощник, разг
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "700"))
 STT_MODEL = os.getenv("STT_MODEL", "whisper-1")
 HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "12"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # сек; 0 — кэш выключен
+# сколько строк истории держим на пользователя (с запасом к окну контекста)
+HISTORY_KEEP_ROWS = HISTORY_MAX_MESSAGES * 10
 USE_CONTEXT_DEFAULT = os.getenv("USE_CONTEXT", "true").lower() == "true"
 
 if not TELEGRAM_BOT_TOKEN:
@@ -41,24 +54,101 @@ logging.info(f"OpenAI SDK version: {getattr(openai_pkg, '__version__', 'unknown'
 
 # --- OpenAI (без прокси) ---
 # Явно создаём httpx-клиент без прокси, чтобы избежать ошибки 'unexpected keyword argument: proxies'
-_httpx_client = httpx.Client(proxies=None, timeout=60)
-client = OpenAI(api_key=OPENAI_API_KEY, http_client=_httpx_client)
+# Асинхронный клиент: запрос к OpenAI не блокирует event loop aiogram,
+# поэтому несколько пользователей обслуживаются параллельно.
+# Явные лимиты пула + keepalive и HTTP/2: соединения переиспользуются,
+# и под всплеском нагрузки httpx не упирается в установку новых TLS-сессий.
+_httpx_client = httpx.AsyncClient(
+    proxies=None,
+    timeout=60,
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_httpx_client)
+
+# Ограничитель параллельных запросов к OpenAI: держим in-flight под RPM
+# нашего тарифа, а временные сбои (429/5xx/таймауты) повторяем с
+# экспоненциальной паузой вместо того, чтобы отдавать ошибку пользователю.
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONC", "20")))
+OPENAI_RETRIES = 3
+_RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+async def with_retries(call):
+    """
+    call: фабрика корутины (например, lambda: client.responses.create(...)).
+    Выполняет её под общим семафором, повторяя временные ошибки.
+    """
+    async with OPENAI_SEM:
+        for attempt in range(OPENAI_RETRIES):
+            try:
+                return await call()
+            except _RETRYABLE_ERRORS:
+                if attempt == OPENAI_RETRIES - 1:
+                    raise
+                delay = 2 ** attempt + random.random()
+                logging.warning("OpenAI: временная ошибка, повтор %d/%d через %.1f c",
+                                attempt + 1, OPENAI_RETRIES, delay, exc_info=True)
+                await asyncio.sleep(delay)
 
 # --- Telegram ---
+class TunedAiohttpSession(AiohttpSession):
+    """
+    Одна aiohttp-сессия на всего бота с длинным keepalive:
+    скачивание голосовых идёт по уже прогретому TLS-соединению,
+    без рукопожатия на каждое сообщение.
+    """
+    def __init__(self):
+        super().__init__()
+        self._connector_init.update(limit=100, keepalive_timeout=75)
+
 dp = Dispatcher()
-bot = Bot(token=TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+bot = Bot(
+    token=TELEGRAM_BOT_TOKEN,
+    session=TunedAiohttpSession(),
+    default=DefaultBotProperties(parse_mode="HTML"),
+)
 
 # --- DB (SQLite) ---
 # Пишем в папку data/, которую можно смонтировать как Volume на Railway
 os.makedirs("data", exist_ok=True)
 DB_PATH = "data/history.db"
 
-def db_connect():
-    return sqlite3.connect(DB_PATH)
+# Одно долгоживущее соединение вместо connect/close на каждый запрос:
+# экономит установку соединения и активирует встроенный кэш
+# подготовленных SQL-запросов sqlite3 (он живёт на соединении).
+# check_same_thread=False + блокировка — на случай вызовов из потоков.
+_conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+_conn.execute("PRAGMA journal_mode=WAL")
+_conn.execute("PRAGMA synchronous=NORMAL")
+_conn.execute("PRAGMA cache_size=-20000")  # 20 МБ страничного кэша
+_db_lock = threading.Lock()
+
+# SQL горячих путей — модульные константы: один и тот же объект строки
+# стабильно попадает во встроенный кэш подготовленных запросов соединения
+# (sqlite3_prepare не выполняется повторно)
+SQL_ADD_MESSAGE = "INSERT INTO messages(user_id, role, content, ts) VALUES(?,?,?,?)"
+SQL_CLEAR_HISTORY = "DELETE FROM messages WHERE user_id=?"
+SQL_GET_HISTORY = """
+    SELECT role, content FROM (
+        SELECT id, role, content FROM messages
+        WHERE user_id=?
+        ORDER BY id DESC
+        LIMIT ?
+    )
+    ORDER BY id ASC
+"""
+SQL_GET_CTX = "SELECT use_context FROM user_settings WHERE user_id=?"
+SQL_SET_CTX = """
+    INSERT INTO user_settings (user_id, use_context)
+    VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET use_context=excluded.use_context
+"""
+SQL_CACHE_GET = "SELECT reply, ts FROM cache WHERE key=?"
+SQL_CACHE_PUT = "INSERT OR REPLACE INTO cache(key, reply, ts) VALUES(?,?,?)"
 
 def db_init():
-    with closing(db_connect()) as conn, conn:
-        conn.execute("""
+    with _db_lock, _conn:
+        _conn.execute("""
         CREATE TABLE IF NOT EXISTS messages(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -67,91 +157,283 @@ def db_init():
             ts INTEGER NOT NULL
         )
         """)
-        conn.execute("""
+        _conn.execute("""
         CREATE TABLE IF NOT EXISTS user_settings(
             user_id INTEGER PRIMARY KEY,
             use_context INTEGER NOT NULL DEFAULT 1
         )
         """)
+        # покрывающий индекс: выборка последних N сообщений пользователя
+        # идёт сканом диапазона индекса, без сортировки всей таблицы
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_msgs_user_id ON messages(user_id, id)")
+        _conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache(
+            key TEXT PRIMARY KEY,
+            reply TEXT NOT NULL,
+            ts INTEGER NOT NULL
+        )
+        """)
+        # скользящее окно истории: триггер удаляет строки за пределами
+        # HISTORY_KEEP_ROWS, так что таблица и индекс не растут бесконечно.
+        # Пересоздаём, потому что размер окна задаётся через ENV.
+        _conn.execute("DROP TRIGGER IF EXISTS trg_prune_messages")
+        _conn.execute(f"""
+        CREATE TRIGGER trg_prune_messages AFTER INSERT ON messages
+        BEGIN
+            DELETE FROM messages
+            WHERE user_id = NEW.user_id
+              AND id <= (
+                  SELECT id FROM messages
+                  WHERE user_id = NEW.user_id
+                  ORDER BY id DESC
+                  LIMIT 1 OFFSET {HISTORY_KEEP_ROWS}
+              );
+        END
+        """)
+
+# Флаг контекста меняется редко, а читается на каждом сообщении —
+# кэшируем его в памяти процесса, чтобы не ходить в SQLite на горячем пути.
+_ctx_cache: dict[int, bool] = {}
 
 def set_use_context(user_id: int, enabled: bool):
-    with closing(db_connect()) as conn, conn:
-        conn.execute("""
-            INSERT INTO user_settings (user_id, use_context)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET use_context=excluded.use_context
-        """, (user_id, 1 if enabled else 0))
+    with _db_lock, _conn:
+        _conn.execute(SQL_SET_CTX, (user_id, 1 if enabled else 0))
+    _ctx_cache[user_id] = enabled
 
 def get_use_context(user_id: int) -> bool:
-    with closing(db_connect()) as conn, conn:
-        cur = conn.execute("SELECT use_context FROM user_settings WHERE user_id=?", (user_id,))
+    cached = _ctx_cache.get(user_id)
+    if cached is not None:
+        return cached
+    with _db_lock:
+        cur = _conn.execute(SQL_GET_CTX, (user_id,))
         row = cur.fetchone()
-        if row is None:
-            return USE_CONTEXT_DEFAULT
-        return bool(row[0])
+    value = USE_CONTEXT_DEFAULT if row is None else bool(row[0])
+    _ctx_cache[user_id] = value
+    return value
 
 def add_message(user_id: int, role: str, content: str):
-    with closing(db_connect()) as conn, conn:
-        conn.execute("INSERT INTO messages(user_id, role, content, ts) VALUES(?,?,?,?)",
-                     (user_id, role, content, int(time.time())))
+    with _db_lock, _conn:
+        _conn.execute(SQL_ADD_MESSAGE, (user_id, role, content, int(time.time())))
+
+def add_messages(user_id: int, pairs: List[Tuple[str, str]]):
+    # Обе записи хода (user + assistant) в одной транзакции:
+    # один commit/fsync вместо двух на каждое сообщение.
+    ts = int(time.time())
+    with _db_lock, _conn:
+        _conn.executemany(SQL_ADD_MESSAGE,
+                          [(user_id, role, content, ts) for role, content in pairs])
 
 def clear_history(user_id: int):
-    with closing(db_connect()) as conn, conn:
-        conn.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
-
-def get_history(user_id: int, limit: int) -> List[Tuple[str, str]]:
-    with closing(db_connect()) as conn, conn:
-        cur = conn.execute("""
-            SELECT role, content FROM messages
-            WHERE user_id=?
-            ORDER BY id DESC
-            LIMIT ?
-        """, (user_id, limit))
-        rows = cur.fetchall()[::-1]
-        return rows
+    with _db_lock, _conn:
+        _conn.execute(SQL_CLEAR_HISTORY, (user_id,))
+
+# Кэш ответов модели: одинаковые вопросы с одинаковой историей не должны
+# стоить полного обращения к OpenAI. Ключ — хэш всего стека сообщений,
+# так что включённый контекст учитывается автоматически.
+def cache_key(messages) -> str:
+    return hashlib.blake2b(repr(messages).encode("utf-8")).hexdigest()
+
+def cache_get(key: str) -> str | None:
+    if not RESPONSE_CACHE_TTL:
+        return None
+    with _db_lock:
+        cur = _conn.execute(SQL_CACHE_GET, (key,))
+        row = cur.fetchone()
+    if row is None or int(time.time()) - row[1] > RESPONSE_CACHE_TTL:
+        return None
+    return row[0]
+
+def cache_put(key: str, reply: str):
+    if not RESPONSE_CACHE_TTL:
+        return
+    with _db_lock, _conn:
+        _conn.execute(SQL_CACHE_PUT, (key, reply, int(time.time())))
+
+def get_history(user_id: int, limit: int) -> List[dict]:
+    with _db_lock:
+        # подзапрос отдаёт последние N строк уже по возрастанию id —
+        # разворот списка на стороне Python не нужен
+        cur = _conn.execute(SQL_GET_HISTORY, (user_id, limit))
+        # сразу в формате OpenAI — без повторной конвертации на каждый запрос
+        return [{"role": r, "content": c} for r, c in cur.fetchall()]
+
+# Асинхронные обёртки над SQLite: синхронный дисковый I/O уходит в поток,
+# чтобы event loop не вставал на каждом fsync и другие пользователи
+# обслуживались параллельно.
+async def aset_use_context(user_id: int, enabled: bool):
+    await asyncio.to_thread(set_use_context, user_id, enabled)
+
+async def aget_use_context(user_id: int) -> bool:
+    return await asyncio.to_thread(get_use_context, user_id)
+
+async def aadd_message(user_id: int, role: str, content: str):
+    await asyncio.to_thread(add_message, user_id, role, content)
+
+async def aadd_messages(user_id: int, pairs: List[Tuple[str, str]]):
+    await asyncio.to_thread(add_messages, user_id, pairs)
+
+async def aclear_history(user_id: int):
+    await asyncio.to_thread(clear_history, user_id)
+
+async def aget_history(user_id: int, limit: int) -> List[dict]:
+    return await asyncio.to_thread(get_history, user_id, limit)
 
 db_init()
 
 # --- Helpers ---
 TG_MAX_TEXT = 4000
 
-async def openai_answer(messages: List[Tuple[str, str]]) -> str:
+# системное сообщение собирается один раз при старте, а не на каждый запрос
+_SYS_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+async def openai_answer(messages: List[dict]) -> str:
     """
-    messages: список пар (role, content) в формате OpenAI ('system'|'user'|'assistant', текст)
+    messages: список {"role": ..., "content": ...} в формате OpenAI
+    ('system'|'user'|'assistant', текст)
     """
+    key = cache_key(messages)
+    cached = await asyncio.to_thread(cache_get, key)
+    if cached is not None:
+        return cached
     try:
-        inputs = [{"role": r, "content": c} for r, c in messages]
-        resp = client.responses.create(
+        resp = await with_retries(lambda: client.responses.create(
             model=OPENAI_MODEL,
-            input=inputs,
+            input=messages,
             max_output_tokens=MAX_TOKENS,
-        )
-        out = getattr(resp, "output_text", None)
-        if isinstance(out, str) and out.strip():
-            return out.strip()
-
-        parts = []
-        for item in getattr(resp, "output", []) or []:
-            if hasattr(item, "content") and item.content:
-                for c in item.content:
-                    if getattr(c, "type", "") == "output_text":
-                        parts.append(c.text)
-        return ("".join(parts) or "Не удалось получить ответ.").strip()
+        ))
+        # горячий путь: для чат-моделей output_text заполнен практически
+        # всегда, разбор resp.output нужен только как холодный fallback
+        reply = (getattr(resp, "output_text", "") or "").strip()
+        if not reply:
+            parts = []
+            for item in getattr(resp, "output", []) or []:
+                if hasattr(item, "content") and item.content:
+                    for c in item.content:
+                        if getattr(c, "type", "") == "output_text":
+                            parts.append(c.text)
+            reply = ("".join(parts) or "Не удалось получить ответ.").strip()
+        # кэшируем только успешные ответы — ошибки не должны «залипать»
+        await asyncio.to_thread(cache_put, key, reply)
+        return reply
     except Exception as e:
         logging.exception("OpenAI error")
         return f"Произошла ошибка при обращении к модели: {e}"
 
-async def transcribe_file(path: str) -> str:
+# --- OpenAI Batch API (для офлайновых задач) ---
+# Массовые прогоны (пересводка истории, миграции, оценки) не должны идти
+# через интерактивный путь: Batch API вдвое дешевле и имеет отдельные,
+# более высокие лимиты. В хендлерах не используется.
+async def submit_batch(requests: List[dict]) -> str:
+    """
+    requests: список body для POST /v1/responses.
+    Загружает JSONL и создаёт batch, возвращает его id.
     """
-    Отправляет аудио-файл в OpenAI для распознавания речи.
+    lines = [
+        json.dumps(
+            {"custom_id": str(i), "method": "POST", "url": "/v1/responses", "body": body},
+            ensure_ascii=False,
+        )
+        for i, body in enumerate(requests)
+    ]
+    data = "\n".join(lines).encode("utf-8")
+    batch_file = await client.files.create(file=("batch.jsonl", data), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    return batch.id
+
+async def wait_for_batch(batch_id: str, poll_interval: float = 60) -> List[dict]:
+    """
+    Ждёт завершения batch (окно — до 24 часов) и возвращает
+    разобранные строки результирующего JSONL.
+    """
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            break
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Batch {batch_id} завершился со статусом {batch.status}")
+        await asyncio.sleep(poll_interval)
+    content = await client.files.content(batch.output_file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line]
+
+# Параметры стриминга: как часто редактировать сообщение в Telegram
+STREAM_EDIT_INTERVAL = 0.4   # сек между edit_message_text
+STREAM_EDIT_CHARS = 200      # или каждые N новых символов
+
+async def stream_answer(message: Message, messages: List[dict]) -> str:
+    """
+    Стримит ответ модели, периодически редактируя сообщение в Telegram:
+    первый текст виден через сотни миллисекунд, а не после полной генерации.
+    Возвращает итоговый текст (для истории). При ошибке стрима
+    откатывается на обычный openai_answer.
+    """
+    key = cache_key(messages)
+    cached = await asyncio.to_thread(cache_get, key)
+    if cached is not None:
+        await reply_long(message, cached)
+        return cached
+
+    placeholder: Message | None = None
+    buf = ""
+    try:
+        last_edit = 0.0
+        last_len = 0
+        # стрим не оборачиваем в повторы (частичный текст уже показан) —
+        # при сбое ниже сработает откат на openai_answer с его retry
+        async with OPENAI_SEM:
+            async with client.responses.stream(
+                model=OPENAI_MODEL,
+                input=messages,
+                max_output_tokens=MAX_TOKENS,
+            ) as stream:
+                async for event in stream:
+                    if event.type != "response.output_text.delta":
+                        continue
+                    buf += event.delta
+                    now = time.monotonic()
+                    if ((now - last_edit >= STREAM_EDIT_INTERVAL or len(buf) - last_len >= STREAM_EDIT_CHARS)
+                            and len(buf) <= TG_MAX_TEXT):
+                        # промежуточные правки без parse_mode: незакрытый HTML
+                        # в недописанном ответе ломает разметку Telegram
+                        try:
+                            if placeholder is None:
+                                placeholder = await message.answer(buf, parse_mode=None)
+                            else:
+                                await placeholder.edit_text(buf, parse_mode=None)
+                            last_edit, last_len = now, len(buf)
+                        except Exception:
+                            pass  # flood-limit и т.п. — дольём текст следующей правкой
+        reply = buf.strip() or "Не удалось получить ответ."
+        await asyncio.to_thread(cache_put, key, reply)
+    except Exception:
+        logging.exception("OpenAI stream error")
+        reply = await openai_answer(messages)
+
+    try:
+        if placeholder is None:
+            await reply_long(message, reply)
+        elif len(reply) <= TG_MAX_TEXT:
+            await placeholder.edit_text(reply)
+        else:
+            await placeholder.delete()
+            await reply_long(message, reply)
+    except Exception:
+        logging.exception("Telegram delivery error")
+    return reply
+
+async def transcribe_audio(data: bytes, filename: str = "audio.mp3") -> str:
+    """
+    Отправляет аудио (байты из памяти) в OpenAI для распознавания речи.
     Возвращает распознанный текст.
     """
     try:
-        with open(path, "rb") as f:
-            tr = client.audio.transcriptions.create(
-                model=STT_MODEL,
-                file=f,
-            )
+        tr = await with_retries(lambda: client.audio.transcriptions.create(
+            model=STT_MODEL,
+            file=(filename, data),
+        ))
         text = getattr(tr, "text", None)
         if isinstance(text, str) and text.strip():
             return text.strip()
@@ -160,45 +442,51 @@ async def transcribe_file(path: str) -> str:
         logging.exception("Transcription error")
         return f"Ошибка распознавания: {e}"
 
-def convert_ogg_to_mp3(src_path: str, dst_path: str):
+async def convert_ogg_to_mp3(ogg_bytes: bytes) -> bytes:
     """
     Конвертация .ogg/.oga (opus) из Telegram в .mp3 через ffmpeg.
+    Всё через pipe: ни исходник, ни результат не пишутся на диск.
     """
-    (
-        ffmpeg
-        .input(src_path)
-        .output(dst_path, format='mp3', acodec='libmp3lame', ac=1, ar='16000')
-        .overwrite_output()
-        .run(quiet=True)
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-v", "quiet",
+        "-i", "pipe:0",
+        "-f", "mp3", "-acodec", "libmp3lame", "-ac", "1", "-ar", "16000",
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
     )
+    mp3_bytes, _ = await proc.communicate(ogg_bytes)
+    if proc.returncode != 0 or not mp3_bytes:
+        raise RuntimeError(f"ffmpeg завершился с кодом {proc.returncode}")
+    return mp3_bytes
 
-def build_message_stack(user_id: int, user_prompt: str) -> List[Tuple[str, str]]:
+async def build_message_stack(user_id: int, user_prompt: str) -> List[dict]:
     """
     Формирует историю для запроса в модель.
     """
-    msgs: List[Tuple[str, str]] = [("system", SYSTEM_PROMPT)]
-    if get_use_context(user_id):
-        hist = get_history(user_id, HISTORY_MAX_MESSAGES)
-        msgs.extend(hist)
-    msgs.append(("user", user_prompt))
-    return msgs
+    hist: List[dict] = []
+    if await aget_use_context(user_id):
+        hist = await aget_history(user_id, HISTORY_MAX_MESSAGES)
+    return [_SYS_MSG, *hist, {"role": "user", "content": user_prompt}]
 
 async def reply_long(message: Message, text: str):
     if len(text) <= TG_MAX_TEXT:
         await message.answer(text)
         return
-    chunk = []
-    total = 0
-    for para in text.split("\n"):
-        if total + len(para) + 1 > TG_MAX_TEXT:
-            await message.answer("\n".join(chunk))
-            chunk = [para]
-            total = len(para) + 1
+    # один проход по тексту: режем по последнему переводу строки в пределах
+    # лимита, без пересборки списков и повторных join
+    i = 0
+    n = len(text)
+    while i < n:
+        end = min(i + TG_MAX_TEXT, n)
+        if end < n:
+            j = text.rfind("\n", i, end)
+            if j <= i:
+                j = end
         else:
-            chunk.append(para)
-            total += len(para) + 1
-    if chunk:
-        await message.answer("\n".join(chunk))
+            j = end
+        await message.answer(text[i:j])
+        i = j + 1 if j < n and text[j:j + 1] == "\n" else j
 
 # --- Handlers ---
 @dp.message(CommandStart())
@@ -214,13 +502,13 @@ async def cmd_start(message: Message):
 
 @dp.message(Command("reset"))
 async def cmd_reset(message: Message):
-    clear_history(message.from_user.id)
+    await aclear_history(message.from_user.id)
     await message.answer("История диалога очищена.")
 
 @dp.message(Command("ctx"))
 async def cmd_ctx(message: Message):
-    current = get_use_context(message.from_user.id)
-    set_use_context(message.from_user.id, not current)
+    current = await aget_use_context(message.from_user.id)
+    await aset_use_context(message.from_user.id, not current)
     status = "включено" if not current else "выключено"
     await message.answer(f"Использование контекста: {status}.")
 
@@ -233,13 +521,11 @@ async def handle_text(message: Message):
 
     await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
 
-    msgs = build_message_stack(user_id, user_text)
-    reply = await openai_answer(msgs)
-
-    add_message(user_id, "user", user_text)
-    add_message(user_id, "assistant", reply)
-
-    await reply_long(message, reply)
+    msgs = await build_message_stack(user_id, user_text)
+    # стриминг сам доставляет ответ по мере генерации;
+    # запись истории остаётся вне критического пути
+    reply = await stream_answer(message, msgs)
+    await aadd_messages(user_id, [("user", user_text), ("assistant", reply)])
 
 @dp.message(F.voice | F.audio)
 async def handle_voice(message: Message):
@@ -259,34 +545,55 @@ async def handle_voice(message: Message):
 
     await bot.send_chat_action(message.chat.id, ChatAction.RECORD_VOICE)
 
-    # скачать файл
+    # скачать файл сразу в память — без временных файлов на диске
     file = await bot.get_file(file_id)
-    src_path = f"data/{file.file_unique_id}.ogg"
-    dst_path = f"data/{file.file_unique_id}.mp3"
-    await bot.download_file(file.file_path, src_path)
+    buf = io.BytesIO()
+    await bot.download_file(file.file_path, destination=buf)
+    ogg_bytes = buf.getvalue()
 
-    # конвертация в mp3 (иногда whisper принимает и ogg, но стабильнее mp3)
-    try:
-        convert_ogg_to_mp3(src_path, dst_path)
-        audio_path = dst_path
-    except Exception:
-        audio_path = src_path  # fallback
+    # voice в Telegram — всегда OGG/Opus, whisper понимает его напрямую,
+    # так что ffmpeg не нужен. Для audio контейнер неизвестен — конвертируем.
+    if message.voice:
+        audio_data, audio_name = ogg_bytes, "audio.ogg"
+    else:
+        try:
+            audio_data = await convert_ogg_to_mp3(ogg_bytes)
+            audio_name = "audio.mp3"
+        except Exception:
+            audio_data, audio_name = ogg_bytes, "audio.ogg"  # fallback
 
     # распознание
     await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
-    recognized = await transcribe_file(audio_path)
+    recognized = await transcribe_audio(audio_data, audio_name)
 
     # ответ как на текст + сохранение истории
-    msgs = build_message_stack(user_id, recognized)
+    msgs = await build_message_stack(user_id, recognized)
     reply = await openai_answer(msgs)
 
-    add_message(user_id, "user", recognized)
-    add_message(user_id, "assistant", reply)
+    await asyncio.gather(
+        aadd_messages(user_id, [("user", recognized), ("assistant", reply)]),
+        reply_long(message, f"🗣️ Распознано: <i>{recognized}</i>\n\n{reply}"),
+    )
 
-    await reply_long(message, f"🗣️ Распознано: <i>{recognized}</i>\n\n{reply}")
+def cleanup_legacy_audio():
+    """
+    Удаляет .ogg/.mp3, оставшиеся в data/ от старых версий бота.
+    Сейчас аудио обрабатывается целиком в памяти, но накопленные ранее
+    файлы продолжали занимать место на томе Railway.
+    """
+    for name in os.listdir("data"):
+        if name.endswith((".ogg", ".oga", ".mp3")):
+            try:
+                os.unlink(os.path.join("data", name))
+            except OSError:
+                pass
 
 async def main():
-    await dp.start_polling(bot)
+    await asyncio.to_thread(cleanup_legacy_audio)
+    # каждый апдейт — отдельная task: медленный ответ OpenAI одному
+    # пользователю не задерживает остальных. Верхнюю границу параллельных
+    # запросов к OpenAI держит OPENAI_SEM.
+    await dp.start_polling(bot, handle_as_tasks=True)
 
 if __name__ == "__main__":
     try: